@@ -1,27 +1,140 @@
-from flask import Flask, request, jsonify, send_file
+from flask import Flask, request, jsonify, send_file, g
 import sqlite3
-import xml.etree.ElementTree as ET
+from lxml import etree
 import openai
 import json
 import os
+import queue
+import threading
+import io
+import uuid
+import hashlib
+import functools
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 # Initialize Flask app
 app = Flask(__name__)
+# Werkzeug spools uploaded files to a temporary file on disk, so this cap bounds disk use
+# rather than memory; anything larger is rejected before the body is read.
+app.config['MAX_CONTENT_LENGTH'] = int(os.environ.get('MAX_UPLOAD_MB', 512)) * 1024 * 1024
 
 # --- Database & LLM Setup ---
 DB_NAME = 'tag_genius.db'
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 8))
+LLM_MAX_WORKERS = int(os.environ.get('LLM_MAX_WORKERS', 32))
+JOB_WORKERS = int(os.environ.get('JOB_WORKERS', 2))
+LLM_MODEL = "gpt-4o-mini"
+# Cached responses are reused for identical prompts, so ask for the most deterministic output
+LLM_TEMPERATURE = 0
+LLM_MAX_RETRIES = int(os.environ.get('LLM_MAX_RETRIES', 3))
+LLM_TIMEOUT_SECONDS = float(os.environ.get('LLM_TIMEOUT_SECONDS', 60))
+LLM_BATCH_SIZE = int(os.environ.get('LLM_BATCH_SIZE', 20))
+# Requests per minute allowed to the LLM API from this process; 0 disables the limit
+LLM_REQUESTS_PER_MINUTE = int(os.environ.get('LLM_REQUESTS_PER_MINUTE', 500))
+LLM_TOKENS_PER_MINUTE = int(os.environ.get('LLM_TOKENS_PER_MINUTE', 200000))
+# Rough size of the reply for one track, used when estimating a call's token usage
+LLM_REPLY_TOKENS_PER_TRACK = 60
+# Cached LLM responses older than this many seconds are ignored; 0 keeps them forever
+LLM_CACHE_TTL = int(os.environ.get('LLM_CACHE_TTL', 0))
+
+# SQL is kept in constants so every call passes the identical string and hits the statement cache
+SQL_INSERT_TRACK = '''
+    INSERT INTO tracks (id, artist, title, track_id, genre, comments, grouping)
+    VALUES (?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT (id) DO UPDATE SET
+        artist = excluded.artist,
+        title = excluded.title,
+        track_id = excluded.track_id,
+        genre = excluded.genre,
+        comments = excluded.comments,
+        grouping = excluded.grouping
+'''
+SQL_SELECT_TRACKS = 'SELECT id, artist, title, track_id, genre, comments, grouping, llm_tags FROM tracks'
+SQL_COUNT_TRACKS = 'SELECT COUNT(*) FROM tracks'
+SQL_CLEAR_TAGS = 'UPDATE tracks SET llm_tags = NULL, llm_tags_key = NULL WHERE llm_tags IS NOT NULL'
+SQL_SELECT_TAG_KEYS = 'SELECT id, llm_tags_key FROM tracks WHERE llm_tags IS NOT NULL AND llm_tags_key IS NOT NULL'
+SQL_UPDATE_TAGS = 'UPDATE tracks SET llm_tags = ?, llm_tags_key = ? WHERE id = ?'
+SQL_INSERT_JOB = "INSERT INTO jobs (id, status, track_count) VALUES (?, 'queued', ?)"
+SQL_UPDATE_JOB = 'UPDATE jobs SET status = ?, tagged_count = ?, skipped_count = ?, error = ? WHERE id = ?'
+SQL_SELECT_JOB = 'SELECT id, status, track_count, tagged_count, skipped_count, error FROM jobs WHERE id = ?'
+SQL_SELECT_LIBRARY_VERSION = 'SELECT version FROM library_version'
+SQL_BUMP_LIBRARY_VERSION = 'UPDATE library_version SET version = version + 1'
+SQL_SELECT_CACHED_TAGS = 'SELECT tags FROM llm_cache WHERE prompt_hash = ? AND created_at >= ?'
+SQL_INSERT_CACHED_TAGS = 'INSERT OR REPLACE INTO llm_cache (prompt_hash, tags, created_at) VALUES (?, ?, ?)'
+
+
+def connect_db():
+    """
+    Opens a new connection to the SQLite database and applies the per-connection PRAGMAs.
+    With the database in WAL mode (see create_database), synchronous=NORMAL means a commit
+    no longer waits on an fsync of the main database file.
+    """
+    conn = sqlite3.connect(DB_NAME, check_same_thread=False, cached_statements=256)
+    conn.row_factory = sqlite3.Row
+    conn.execute('PRAGMA synchronous=NORMAL')
+    conn.execute('PRAGMA cache_size=-65536')
+    conn.execute('PRAGMA temp_store=MEMORY')
+    conn.execute('PRAGMA mmap_size=268435456')
+    return conn
+
+
+class DatabaseBusyError(Exception):
+    """Raised when every pooled connection stays in use for longer than the acquire timeout."""
+
+
+class SqlitePool:
+    """
+    A bounded pool of pre-opened SQLite connections.
+    Callers borrow a connection with acquire() and hand it back with release(),
+    so the hot path never pays for opening a new database handle.
+    """
+
+    def __init__(self, size):
+        self._size = size
+        self._connections = queue.Queue(maxsize=size)
+        for _ in range(size):
+            self._connections.put(connect_db())
+
+    def acquire(self, timeout=30):
+        """Borrows a connection, waiting up to `timeout` seconds for one to free up."""
+        try:
+            return self._connections.get(timeout=timeout)
+        except queue.Empty:
+            raise DatabaseBusyError(f"All {self._size} database connections are busy. "
+                                    "Please try again shortly.") from None
+
+    def release(self, conn):
+        """Returns a connection to the pool, discarding any uncommitted work."""
+        if conn.in_transaction:
+            conn.rollback()
+        self._connections.put(conn)
 
 
 def get_db_connection():
-    """Establishes a connection to the SQLite database."""
-    conn = sqlite3.connect(DB_NAME)
-    conn.row_factory = sqlite3.Row
-    return conn
+    """
+    Returns the pooled connection for the current request, borrowing it on first use.
+    The connection goes back to the pool in close_db when the app context is torn down.
+    """
+    if 'db' not in g:
+        g.db = db_pool.acquire()
+    return g.db
+
+
+@app.teardown_appcontext
+def close_db(exception):
+    """Returns the request's database connection to the pool, if one was borrowed."""
+    db = g.pop('db', None)
+    if db is not None:
+        db_pool.release(db)
 
 
 def create_database():
     """Creates the necessary tables if they don't exist."""
-    conn = get_db_connection()
+    conn = connect_db()
+    # WAL is stored in the database file itself, so it only needs switching on once;
+    # it lets readers run alongside a writer
+    conn.execute('PRAGMA journal_mode=WAL')
     conn.execute('''
                  CREATE TABLE IF NOT EXISTS tracks
                  (
@@ -42,32 +155,129 @@ def create_database():
                      grouping
                      TEXT,
                      llm_tags
+                     TEXT,
+                     llm_tags_key
                      TEXT
                  )
                  ''')
+    conn.execute('''
+                 CREATE TABLE IF NOT EXISTS jobs
+                 (
+                     id TEXT PRIMARY KEY,
+                     status TEXT NOT NULL,
+                     track_count INTEGER,
+                     tagged_count INTEGER,
+                     skipped_count INTEGER,
+                     error TEXT
+                 )
+                 ''')
+    conn.execute('''
+                 CREATE TABLE IF NOT EXISTS llm_cache
+                 (
+                     prompt_hash TEXT PRIMARY KEY,
+                     tags TEXT NOT NULL,
+                     created_at INTEGER NOT NULL
+                 )
+                 ''')
+    conn.execute('''
+                 CREATE TABLE IF NOT EXISTS library_version
+                 (
+                     id INTEGER PRIMARY KEY CHECK (id = 0),
+                     version INTEGER NOT NULL
+                 )
+                 ''')
+    # Columns added after a table was first released aren't created by IF NOT EXISTS
+    add_missing_column(conn, 'tracks', 'llm_tags_key', 'TEXT')
+    add_missing_column(conn, 'jobs', 'skipped_count', 'INTEGER')
+    conn.execute('INSERT OR IGNORE INTO library_version (id, version) VALUES (0, 0)')
     conn.commit()
     conn.close()
 
 
-# Initial database creation
+def add_missing_column(conn, table, column, definition):
+    """Adds a column to a table created by an older version of the app."""
+    columns = {row['name'] for row in conn.execute(f'PRAGMA table_info({table})')}
+    if column not in columns:
+        conn.execute(f'ALTER TABLE {table} ADD COLUMN {column} {definition}')
+
+
+# Initial database creation, then open the connection pool against the ready database
 create_database()
+db_pool = SqlitePool(DB_POOL_SIZE)
+
+
+# --- LLM Prompt ---
+# The prompt is assembled from fixed pieces so only the track details are formatted per call.
+# SYSTEM_PROMPT is byte-identical for every call, which lets OpenAI's prompt caching reuse it;
+# everything that varies goes in the user message after it.
+TAG_CATEGORIES = ('primary_genre', 'sub_genre', 'energy_vibe', 'situation_environment', 'components', 'time_period')
+
+PROMPT_INTRO = """You are a master music curator, specializing in providing precise and accurate tags for a DJ's music library.
+Your task is to analyze the provided track details and generate a list of tags for the following categories:
+- Primary Genre
+- Sub-genre
+- Energy/Vibe
+- Situation/Environment
+- Components
+- Time Period
+
+For each category, provide exactly the number of tags specified in the request. If a category has fewer relevant tags, provide all of them. Do not exceed the specified number.
+
+"""
+
+PROMPT_TAG_COUNTS = """Primary Genre: exactly {primary_genre} tag.
+Sub-genre: exactly {sub_genre} tags.
+Energy/Vibe: exactly {energy_vibe} tags.
+Situation/Environment: exactly {situation_environment} tags.
+Components: exactly {components} tags.
+Time Period: exactly {time_period} tag.
+
+"""
+
+PROMPT_FORMAT_RULES = """Write the tags for a track as a single, comma-separated string, with each tag enclosed in square brackets.
+The format MUST be: [Primary Genre],[Sub-genre1],[Sub-genre2],...
+Do not add any other text, explanations, or headings to the tag string.
+
+"""
+
+SYSTEM_PROMPT = PROMPT_INTRO + PROMPT_FORMAT_RULES
+
+PROMPT_TRACK_DETAILS = """Track Details:
+Artist: {artist}
+Title: {title}
+Genre: {genre}
+Grouping: {grouping}
+Comments: {comments}
+
+Respond with the tag string only.
+"""
+
+PROMPT_BATCH_TRACKS = """Tag each of the tracks listed below, one JSON object per line.
+Respond with a JSON object of the form {"tracks": [{"index": <track index>, "tags": "<tag string>"}, ...]}
+containing exactly one entry for every track.
+
+Tracks:
+"""
 
 
 # --- Utility Functions ---
 
-def parse_rekordbox_xml(xml_content):
+def parse_rekordbox_xml(xml_file):
     """
-    Parses Rekordbox XML content and extracts relevant track data.
+    Streams the relevant track data out of a Rekordbox XML file object.
+    Every TRACK element, including the playlist references, is discarded once it has been
+    read, so the parse tree never grows with the size of the library.
     """
-    root = ET.fromstring(xml_content)
-    # Define the namespace map
-    namespace = {'ns': 'http://www.rekordbox.com'}
-    collection = root.find('.//ns:COLLECTION', namespace)
-    tracks = []
-    if collection is not None:
-        for track_node in collection.findall('.//ns:TRACK', namespace):
-            track_data = track_node.attrib
-            tracks.append({
+    # '{*}' matches TRACK with or without the rekordbox namespace, and lxml filters
+    # out every other element before it reaches Python. Entities are left unresolved and
+    # nothing is fetched over the network, so an upload can't pull in files from the server.
+    for _, elem in etree.iterparse(xml_file, events=('end',), tag='{*}TRACK',
+                                   resolve_entities=False, no_network=True):
+        parent = elem.getparent()
+        # Only COLLECTION holds full tracks; PLAYLISTS just reference them by key
+        if etree.QName(parent).localname == 'COLLECTION':
+            track_data = elem.attrib
+            yield {
                 'id': track_data.get('Location'),
                 'artist': track_data.get('Artist'),
                 'title': track_data.get('Name'),
@@ -75,51 +285,91 @@ def parse_rekordbox_xml(xml_content):
                 'genre': track_data.get('Genre'),
                 'comments': track_data.get('Comments'),
                 'grouping': track_data.get('Grouping')
-            })
-    return tracks
+            }
+        parent.remove(elem)
+
+
+class RateLimiter:
+    """
+    Spaces calls out so that no more than `per_minute` units are used in any minute, across
+    all threads. Pacing requests up front avoids bursts of 429s once many LLM calls run
+    concurrently.
+    """
+
+    def __init__(self, per_minute):
+        self._interval = 60.0 / per_minute if per_minute > 0 else 0
+        self._lock = threading.Lock()
+        self._next_slot = time.monotonic()
 
+    def acquire(self, units=1):
+        """Blocks until the caller may start a call that uses `units` of the budget."""
+        if not self._interval:
+            return
+        with self._lock:
+            now = time.monotonic()
+            slot = max(self._next_slot, now)
+            self._next_slot = slot + self._interval * units
+        if slot > now:
+            time.sleep(slot - now)
 
-def call_llm_for_tags(track_data, tag_config):
+
+llm_request_limiter = RateLimiter(LLM_REQUESTS_PER_MINUTE)
+llm_token_limiter = RateLimiter(LLM_TOKENS_PER_MINUTE)
+
+
+def wait_for_llm_capacity(prompt, track_count):
+    """
+    Blocks until an LLM call fits within both the request and the token rate limits.
+    Tokens are estimated at about four characters each, plus the expected reply.
+    """
+    llm_request_limiter.acquire()
+    estimated_tokens = (len(SYSTEM_PROMPT) + len(prompt)) // 4 + track_count * LLM_REPLY_TOKENS_PER_TRACK
+    llm_token_limiter.acquire(estimated_tokens)
+
+
+@functools.lru_cache(maxsize=1)
+def get_llm_client():
+    """
+    Returns the shared OpenAI client, creating it on first use.
+    The client pools its HTTP connections, so reusing it keeps them alive between tracks
+    instead of paying for a new TCP and TLS handshake on every LLM call. Rate limits and
+    server errors are retried by the client with exponential backoff, and a stalled request
+    times out instead of holding one of the pooled connections.
+    """
+    return openai.OpenAI(max_retries=LLM_MAX_RETRIES, timeout=LLM_TIMEOUT_SECONDS)
+
+
+def build_prompt_prefix(tag_config):
+    """
+    Builds the start of the user message, which is shared by every track in a library.
+    Call it once per library; call_llm_for_tags only appends the track details.
+    """
+    tag_counts = {category: tag_config.get(category, 1) for category in TAG_CATEGORIES}
+    return PROMPT_TAG_COUNTS.format(**tag_counts)
+
+
+def call_llm_for_tags(track_data, prompt_prefix):
     """
     Generates tags for a single track using an LLM.
-    The prompt is now more precise, based on the tag_config dictionary.
-    """
-    prompt = f"""
-    You are a master music curator, specializing in providing precise and accurate tags for a DJ's music library.
-    Your task is to analyze the provided track details and generate a list of tags for the following categories:
-    - Primary Genre
-    - Sub-genre
-    - Energy/Vibe
-    - Situation/Environment
-    - Components
-    - Time Period
-
-    For each category, provide exactly the number of tags specified below. If a category has fewer relevant tags, provide all of them. Do not exceed the specified number.
-
-    Primary Genre: exactly {tag_config.get('primary_genre', 1)} tag.
-    Sub-genre: exactly {tag_config.get('sub_genre', 1)} tags.
-    Energy/Vibe: exactly {tag_config.get('energy_vibe', 1)} tags.
-    Situation/Environment: exactly {tag_config.get('situation_environment', 1)} tags.
-    Components: exactly {tag_config.get('components', 1)} tags.
-    Time Period: exactly {tag_config.get('time_period', 1)} tag.
-
-    Return the tags as a single, comma-separated string, with each tag enclosed in square brackets.
-    The format MUST be: [Primary Genre],[Sub-genre1],[Sub-genre2],...
-    Do not add any other text, explanations, or headings to your response.
-
-    Track Details:
-    Artist: {track_data.get('artist')}
-    Title: {track_data.get('title')}
-    Genre: {track_data.get('genre')}
-    Grouping: {track_data.get('grouping')}
-    Comments: {track_data.get('comments')}
-    """
-
-    client = openai.OpenAI()
+    prompt_prefix comes from build_prompt_prefix and carries the tag counts for the library.
+    """
+    prompt = prompt_prefix + PROMPT_TRACK_DETAILS.format(
+        artist=track_data.get('artist'),
+        title=track_data.get('title'),
+        genre=track_data.get('genre'),
+        grouping=track_data.get('grouping'),
+        comments=track_data.get('comments')
+    )
+
     try:
-        response = client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[{"role": "user", "content": prompt}]
+        wait_for_llm_capacity(prompt, 1)
+        response = get_llm_client().chat.completions.create(
+            model=LLM_MODEL,
+            messages=[
+                {"role": "system", "content": SYSTEM_PROMPT},
+                {"role": "user", "content": prompt}
+            ],
+            temperature=LLM_TEMPERATURE
         )
         # Extract the tag string and remove any whitespace
         tags_string = response.choices[0].message.content.strip()
@@ -129,53 +379,259 @@ def call_llm_for_tags(track_data, tag_config):
         return None
 
 
-def generate_rekordbox_xml(tracks, output_file_path):
+def call_llm_for_tags_batch(tracks, prompt_prefix):
     """
-    Generates a new Rekordbox XML file with updated tags.
+    Generates tags for several tracks with a single LLM call, returning them in track order.
+    Sharing one request amortizes the round trip and the prompt across the batch. If the
+    response can't be parsed, the batch is split in half and each half retried; any track a
+    usable response leaves out or gives a malformed entry is retried on its own with
+    call_llm_for_tags. If the API call
+    itself fails (after the client's own retries), the whole batch is left untagged.
     """
-    # Create the root element
-    root = ET.Element('DJ_PLAYLISTS', version='1.0.0')
+    if len(tracks) == 1:
+        return [call_llm_for_tags(tracks[0], prompt_prefix)]
+
+    track_lines = [json.dumps({
+        'index': index,
+        'artist': track_data.get('artist'),
+        'title': track_data.get('title'),
+        'genre': track_data.get('genre'),
+        'grouping': track_data.get('grouping'),
+        'comments': track_data.get('comments')
+    }, ensure_ascii=False) for index, track_data in enumerate(tracks)]
+    prompt = prompt_prefix + PROMPT_BATCH_TRACKS + '\n'.join(track_lines)
 
-    # Add the product and settings elements
-    product = ET.SubElement(root, 'PRODUCT', Name='rekordbox', Version='6.7.7')
-    settings = ET.SubElement(root, 'SETTINGS')
+    try:
+        wait_for_llm_capacity(prompt, len(tracks))
+        response = get_llm_client().chat.completions.create(
+            model=LLM_MODEL,
+            messages=[
+                {"role": "system", "content": SYSTEM_PROMPT},
+                {"role": "user", "content": prompt}
+            ],
+            response_format={"type": "json_object"},
+            temperature=LLM_TEMPERATURE
+        )
+    except openai.APIError as e:
+        print(f"Error calling LLM for a batch of {len(tracks)} tracks: {e}")
+        return [None] * len(tracks)
 
-    # Add the collection with all tracks
-    collection = ET.SubElement(root, 'COLLECTION', Entries=str(len(tracks)))
+    try:
+        entries = json.loads(response.choices[0].message.content)['tracks']
+        if not isinstance(entries, list):
+            raise TypeError('"tracks" is not a list')
+    except (ValueError, KeyError, TypeError, AttributeError) as e:
+        print(f"Unusable LLM response for a batch of {len(tracks)} tracks: {e}")
+        middle = len(tracks) // 2
+        return (call_llm_for_tags_batch(tracks[:middle], prompt_prefix) +
+                call_llm_for_tags_batch(tracks[middle:], prompt_prefix))
+
+    # A malformed entry is skipped on its own; its track falls through to the single-track retry
+    tags_by_index = {}
+    for entry in entries:
+        if not isinstance(entry, dict):
+            continue
+        index, tags = entry.get('index'), entry.get('tags')
+        # JSON mode sometimes returns the index as a string, so normalise it
+        if isinstance(index, str) and index.strip().isdigit():
+            index = int(index)
+        # type() rather than isinstance() so that a bool isn't taken for an index
+        if type(index) is not int or not 0 <= index < len(tracks):
+            continue
+        if isinstance(tags, str) and tags.strip():
+            tags_by_index[index] = tags.strip()
+
+    return [tags_by_index[index] if index in tags_by_index else call_llm_for_tags(track_data, prompt_prefix)
+            for index, track_data in enumerate(tracks)]
+
+
+def llm_cache_key(track_data, tag_config):
+    """
+    Hashes every input to the tagging prompt, so tracks with equal keys get the same prompt
+    and can share a cached LLM response.
+    """
+    prompt_inputs = json.dumps([
+        LLM_MODEL,
+        track_data.get('artist'),
+        track_data.get('title'),
+        track_data.get('genre'),
+        track_data.get('comments'),
+        track_data.get('grouping'),
+        tag_config
+    ], sort_keys=True)
+    return hashlib.blake2b(prompt_inputs.encode('utf-8'), digest_size=16).hexdigest()
+
+
+def generate_rekordbox_xml(tracks, entries):
+    """
+    Generates a new Rekordbox XML document with updated tags and returns it as bytes.
+    Tracks are written one element at a time, so the whole document never exists as a tree.
+    """
+    buffer = io.BytesIO()
+    with etree.xmlfile(buffer, encoding='utf-8') as xml_file:
+        xml_file.write_declaration()
+        with xml_file.element('DJ_PLAYLISTS', version='1.0.0'):
+            # Add the product and settings elements
+            xml_file.write(etree.Element('PRODUCT', Name='rekordbox', Version='6.7.7'))
+            xml_file.write(etree.Element('SETTINGS'))
+
+            # Add the collection with all tracks
+            with xml_file.element('COLLECTION', Entries=str(entries)):
+                # Rows are plain tuples in SQL_SELECT_TRACKS column order
+                for location, artist, title, track_id, genre, comments, grouping, llm_tags in tracks:
+                    track = etree.Element('TRACK')
+                    track.set('Name', title if title is not None else '')
+                    track.set('Artist', artist if artist is not None else '')
+                    track.set('TrackID', str(track_id) if track_id is not None else '')
+                    track.set('Location', location if location is not None else '')
+
+                    # Add original attributes
+                    if genre is not None:
+                        track.set('Genre', genre)
+                    if comments is not None:
+                        track.set('Comments', comments)
+
+                    # Add the generated tags to the Grouping field
+                    if llm_tags is not None:
+                        # Append the original grouping data to the comments for backup
+                        if grouping is not None and grouping != '':
+                            track.set('Comments', f"{comments} | ORIGINAL_GROUPING: {grouping}")
+
+                        # Put the new tags in the Grouping field
+                        track.set('Grouping', llm_tags)
+
+                    xml_file.write(track)
+
+    return buffer.getvalue()
+
+
+# --- Export Cache ---
+# The exported XML only changes when the tracks table does, so the last export is kept
+# in memory. Every write to tracks also bumps library_version in the same transaction,
+# which lets each worker process check its cached export with a single-row read.
+_export_cache = {'version': None, 'xml': None}
+_export_cache_lock = threading.Lock()
+
+
+def bump_library_version(conn):
+    """Marks the tracks table as changed. Call inside the transaction that changes it."""
+    conn.execute(SQL_BUMP_LIBRARY_VERSION)
+
+
+def get_cached_export(version):
+    """Returns the cached export if it was built at the given library version, else None."""
+    with _export_cache_lock:
+        if _export_cache['version'] == version:
+            return _export_cache['xml']
+        return None
 
-    for track_data in tracks:
-        track = ET.SubElement(collection, 'TRACK')
-        track.set('Name', track_data['title'] if track_data['title'] is not None else '')
-        track.set('Artist', track_data['artist'] if track_data['artist'] is not None else '')
-        track.set('TrackID', track_data['track_id'] if track_data['track_id'] is not None else '')
-        track.set('Location', track_data['id'] if track_data['id'] is not None else '')
 
-        # Add original attributes
-        if track_data['genre'] is not None:
-            track.set('Genre', track_data['genre'])
-        if track_data['comments'] is not None:
-            track.set('Comments', track_data['comments'])
+def store_cached_export(xml_bytes, version):
+    """Caches an export built at the given library version."""
+    with _export_cache_lock:
+        _export_cache['version'] = version
+        _export_cache['xml'] = xml_bytes
 
-        # Add the generated tags to the Grouping field
-        if track_data['llm_tags'] is not None:
-            # Append the original grouping data to the comments for backup
-            if track_data['grouping'] is not None and track_data['grouping'] != '':
-                track.set('Comments', f"{track_data['comments']} | ORIGINAL_GROUPING: {track_data['grouping']}")
 
-            # Put the new tags in the Grouping field
-            track.set('Grouping', track_data['llm_tags'])
+# --- Background Jobs ---
+# Tagging a library means one LLM round trip per track, which can take minutes, so it runs
+# off the request thread. Job progress lives in the jobs table for /jobs/<job_id> to report.
+job_executor = ThreadPoolExecutor(max_workers=JOB_WORKERS)
 
-    tree = ET.ElementTree(root)
-    ET.indent(tree, space="\t", level=0)
-    tree.write(output_file_path, encoding='utf-8', xml_declaration=True)
+
+def set_job_status(job_id, status, tagged_count=None, skipped_count=None, error=None):
+    """Records a job's progress using a connection borrowed from the pool."""
+    conn = db_pool.acquire()
+    try:
+        conn.execute(SQL_UPDATE_JOB, (status, tagged_count, skipped_count, error, job_id))
+        conn.commit()
+    finally:
+        db_pool.release(conn)
+
+
+def tag_library_job(job_id, tracks, tag_config):
+    """
+    Generates tags for an uploaded library and stores them against the already-inserted tracks.
+    A track is skipped when its stored tags were generated from the same prompt inputs it has
+    now; other tracks with previously seen inputs are served from llm_cache.
+    """
+    try:
+        set_job_status(job_id, 'running')
+
+        now = int(time.time())
+        oldest_allowed = now - LLM_CACHE_TTL if LLM_CACHE_TTL > 0 else 0
+        conn = db_pool.acquire()
+        try:
+            # Tracks already tagged from identical prompt inputs keep their tags untouched
+            stored_keys = {row['id']: row['llm_tags_key'] for row in conn.execute(SQL_SELECT_TAG_KEYS)}
+            keys = [llm_cache_key(track, tag_config) for track in tracks]
+            pending = [(track, key) for track, key in zip(tracks, keys) if stored_keys.get(track.get('id')) != key]
+            skipped_count = len(tracks) - len(pending)
+
+            # Reuse earlier responses for identical prompts, e.g. when a library is re-imported
+            cached_tags = {}
+            for key in {key for _, key in pending}:
+                row = conn.execute(SQL_SELECT_CACHED_TAGS, (key, oldest_allowed)).fetchone()
+                if row is not None:
+                    cached_tags[key] = row['tags']
+        finally:
+            db_pool.release(conn)
+
+        # A track with neither artist nor title gives the LLM nothing to go on, so it is left untagged.
+        # Tracks with equal keys get the same prompt, so each distinct key is sent only once.
+        unique_misses = {}
+        for track, key in pending:
+            if key not in cached_tags and (track.get('artist') or track.get('title')):
+                unique_misses.setdefault(key, track)
+        misses = [(track, key) for key, track in unique_misses.items()]
+
+        # Tag the misses a batch per LLM call, with the calls running concurrently since
+        # they are network-bound
+        prompt_prefix = build_prompt_prefix(tag_config)
+        batches = [[track for track, _ in misses[start:start + LLM_BATCH_SIZE]]
+                   for start in range(0, len(misses), LLM_BATCH_SIZE)]
+        with ThreadPoolExecutor(max_workers=LLM_MAX_WORKERS) as executor:
+            batch_tags = executor.map(lambda batch: call_llm_for_tags_batch(batch, prompt_prefix), batches)
+            new_tags = [llm_tags for tags in batch_tags for llm_tags in tags]
+
+        new_cache_rows = []
+        for (_, key), llm_tags in zip(misses, new_tags):
+            if llm_tags is not None:
+                cached_tags[key] = llm_tags
+                new_cache_rows.append((key, llm_tags, now))
+
+        # A track the LLM couldn't tag keeps whatever tags it had before
+        rows = [(cached_tags[key], key, track.get('id')) for track, key in pending if key in cached_tags]
+        tagged_count = len(rows)
+
+        conn = db_pool.acquire()
+        try:
+            conn.executemany(SQL_UPDATE_TAGS, rows)
+            conn.executemany(SQL_INSERT_CACHED_TAGS, new_cache_rows)
+            conn.execute(SQL_UPDATE_JOB, ('finished', tagged_count, skipped_count, None, job_id))
+            bump_library_version(conn)
+            conn.commit()
+        finally:
+            db_pool.release(conn)
+
+    except Exception as e:
+        print(f"Error tagging library for job {job_id}: {e}")
+        set_job_status(job_id, 'failed', error=str(e))
 
 
 # --- Flask Endpoints ---
 
+@app.errorhandler(413)
+def upload_too_large(error):
+    """Reports uploads over MAX_CONTENT_LENGTH in the same JSON shape as the other errors."""
+    return jsonify({'error': 'The uploaded file is too large.'}), 413
+
+
 @app.route('/upload_library', methods=['POST'])
 def upload_library():
     """
-    Receives an XML file, processes it, and stores it in the database.
+    Receives an XML file, stores its tracks in the database and queues them for tagging.
+    Responds with 202 and a job id straight away; the client polls /jobs/<job_id> for progress.
     """
     if 'file' not in request.files:
         return jsonify({'error': 'No file part in the request'}), 400
@@ -190,33 +646,55 @@ def upload_library():
     tag_config = json.loads(config_json)
 
     try:
-        xml_content = file.read()
-        tracks = parse_rekordbox_xml(xml_content)
+        # Parse straight from the upload stream rather than reading the whole file into memory
+        tracks = list(parse_rekordbox_xml(file.stream))
 
-        conn = get_db_connection()
+        rows = []
         for track in tracks:
-            # Store the original tags in case we need to clear them later
-            track_id = track.get('id')
-            llm_tags = call_llm_for_tags(track, tag_config)
-
-            conn.execute('''
-                INSERT OR REPLACE INTO tracks (id, artist, title, track_id, genre, comments, grouping, llm_tags)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-            ''', (
-                track_id,
+            rows.append((
+                track.get('id'),
                 track.get('artist'),
                 track.get('title'),
                 track.get('track_id'),
                 track.get('genre'),
                 track.get('comments'),
-                track.get('grouping'),
-                llm_tags
+                track.get('grouping')
             ))
+
+        # Write the whole library in one statement and one transaction, along with its job
+        job_id = uuid.uuid4().hex
+        conn = get_db_connection()
+        conn.executemany(SQL_INSERT_TRACK, rows)
+        conn.execute(SQL_INSERT_JOB, (job_id, len(tracks)))
+        bump_library_version(conn)
         conn.commit()
-        conn.close()
+        # Refresh the planner statistics now that the table may have grown substantially
+        conn.execute('PRAGMA optimize')
 
-        return jsonify({'message': 'Library uploaded and processed successfully!'}), 200
+        job_executor.submit(tag_library_job, job_id, tracks, tag_config)
 
+        return jsonify({'message': 'Library uploaded. Tagging has started.', 'job_id': job_id,
+                        'status': 'queued'}), 202
+
+    except DatabaseBusyError as e:
+        return jsonify({'error': str(e)}), 503
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    """
+    Reports the progress of a tagging job started by /upload_library.
+    """
+    try:
+        conn = get_db_connection()
+        job = conn.execute(SQL_SELECT_JOB, (job_id,)).fetchone()
+        if job is None:
+            return jsonify({'error': 'Job not found'}), 404
+        return jsonify(dict(job)), 200
+    except DatabaseBusyError as e:
+        return jsonify({'error': str(e)}), 503
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
@@ -228,18 +706,28 @@ def export_xml():
     """
     try:
         conn = get_db_connection()
-        cursor = conn.execute('SELECT * FROM tracks')
-        tracks = cursor.fetchall()
-        conn.close()
-
-        if not tracks:
-            return jsonify({'error': 'No tracks found in the database. Please upload a library first.'}), 404
-
-        output_file_path = "tagged_library.xml"
-        generate_rekordbox_xml(tracks, output_file_path)
-
-        return send_file(output_file_path, as_attachment=True)
-
+        # Read the version, count and tracks from one snapshot so they agree with each other
+        conn.execute('BEGIN')
+        version = conn.execute(SQL_SELECT_LIBRARY_VERSION).fetchone()['version']
+        xml_bytes = get_cached_export(version)
+        if xml_bytes is None:
+            track_count = conn.execute(SQL_COUNT_TRACKS).fetchone()[0]
+            if track_count == 0:
+                return jsonify({'error': 'No tracks found in the database. Please upload a library first.'}), 404
+
+            # Fetch plain tuples; generate_rekordbox_xml unpacks them positionally
+            cursor = conn.cursor()
+            cursor.row_factory = None
+            cursor.execute(SQL_SELECT_TRACKS)
+            xml_bytes = generate_rekordbox_xml(cursor, track_count)
+            store_cached_export(xml_bytes, version)
+        conn.rollback()
+
+        return send_file(io.BytesIO(xml_bytes), mimetype='application/xml', as_attachment=True,
+                         download_name='tagged_library.xml')
+
+    except DatabaseBusyError as e:
+        return jsonify({'error': str(e)}), 503
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
@@ -251,12 +739,18 @@ def clear_tags():
     """
     try:
         conn = get_db_connection()
-        conn.execute('UPDATE tracks SET llm_tags = NULL')
+        cursor = conn.execute(SQL_CLEAR_TAGS)
+        if cursor.rowcount > 0:
+            bump_library_version(conn)
         conn.commit()
-        conn.close()
-        return jsonify({'message': 'Generated tags have been cleared successfully.'}), 200
+        return jsonify({'message': 'Generated tags have been cleared successfully.',
+                        'cleared': cursor.rowcount}), 200
+    except DatabaseBusyError as e:
+        return jsonify({'error': str(e)}), 503
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
 if __name__ == '__main__':
-    app.run(debug=True)
+    # Development server only; Flask enables debug mode when FLASK_DEBUG=1.
+    # Production runs under gunicorn via wsgi.py.
+    app.run()
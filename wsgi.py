@@ -0,0 +1,13 @@
+"""
+Production entry point for Tag Genius.
+
+Run with:
+    gunicorn -k gevent -w 4 --worker-connections 1000 wsgi:app
+"""
+# Patch the standard library before anything else imports it, so sockets, threads and
+# queues cooperate with gevent's event loop
+from gevent import monkey
+
+monkey.patch_all()
+
+from app import app  # noqa: E402